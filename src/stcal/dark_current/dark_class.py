@@ -1,3 +1,5 @@
+import copy
+
 import numpy as np
 from astropy import units as u
 
@@ -107,3 +109,25 @@ class ScienceData:  # noqa: D101
             self.exp_intstart = None
 
             self.cal_step = None
+
+    def shallow_copy_with_data(self, data):
+        """
+        Create a copy of the science data with a new data array.
+
+        All attributes other than the data array are shared with this
+        object by reference, so no arrays or metadata are copied.
+
+        Parameters
+        ----------
+        data : ndarray
+            The data array for the new science data.
+
+        Returns
+        -------
+        ScienceData
+            Science data with the given data array and all other
+            attributes taken from this object.
+        """
+        new = copy.copy(self)
+        new.data = data
+        return new
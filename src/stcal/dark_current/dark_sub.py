@@ -2,7 +2,6 @@
 #  Module for dark subtracting science data sets
 #
 
-import copy
 import logging
 import warnings
 
@@ -69,6 +68,15 @@ def do_correction_data(science_data, dark_data, dark_output=None):
     averaged_dark : DarkData
         New dark object with averaged frames
     """
+    # Make sure the data arrays are C-contiguous, so the frame averaging
+    # and subtraction below all run on contiguous memory
+    if not science_data.data.flags["C_CONTIGUOUS"]:
+        log.debug("Making a contiguous copy of the science data")
+        science_data.data = np.ascontiguousarray(science_data.data)
+    if not dark_data.data.flags["C_CONTIGUOUS"]:
+        log.debug("Making a contiguous copy of the dark data")
+        dark_data.data = np.ascontiguousarray(dark_data.data)
+
     # Save some data params for easy use later
     sci_nints = science_data.data.shape[0]
     sci_ngroups = science_data.data.shape[1]
@@ -124,10 +132,12 @@ def do_correction_data(science_data, dark_data, dark_output=None):
             "Input will be returned without subtracting dark current."
         )
         science_data.cal_step = "SKIPPED"
-        out_data = copy.deepcopy(science_data)
+        out_data = science_data.shallow_copy_with_data(science_data.data)
         return out_data, None
 
-    # Replace NaN's in the dark with zeros
+    # Replace NaN's in the dark with zeros.  A single boolean mask is
+    # cheaper here than np.nan_to_num, which builds separate NaN and
+    # infinity masks and would also replace infinite values.
     dark_data.data[np.isnan(dark_data.data)] = 0.0
 
     # Check whether the dark and science data have matching
@@ -145,6 +155,11 @@ def do_correction_data(science_data, dark_data, dark_output=None):
             averaged_dark.save = True
             averaged_dark.output_name = dark_output
 
+    elif dark_output is None and len(dark_data.data.shape) == 3:
+        # The frame-averaged dark is not saved, so average and subtract
+        # the dark one group at a time instead of building all of it.
+        output_data = _avg_and_subtract_streaming(science_data, dark_data, sci_nframes, sci_groupgap)
+
     else:
         # Create a frame-averaged version of the dark data to match
         # the nframes and groupgap settings of the science data.
@@ -208,28 +223,9 @@ def average_dark_frames_3d(dark_data, ngroups, nframes, groupgap):
     # Do a direct copy of the 2-d DQ array into the new dark
     avg_dark.groupdq = dark_data.groupdq
 
-    # Loop over the groups of the input science data, copying or
-    # averaging the dark frames to match the group structure
-    start = 0
-
-    for group in range(ngroups):
-        end = start + nframes
-
-        # If there's only 1 frame per group, just copy the dark frames
-        if nframes == 1:
-            log.debug("copy dark frame %d", start)
-            avg_dark.data[group] = dark_data.data[start]
-
-        # Otherwise generate new group by taking the mean of the SCI array nframes.
-        else:
-            log.debug("average dark frames %d to %d", start + 1, end)
-            with warnings.catch_warnings():
-                warnings.filterwarnings("ignore", "Mean of empty slice", RuntimeWarning)
-                warnings.filterwarnings("ignore", "invalid value", RuntimeWarning)
-                avg_dark.data[group] = dark_data.data[start:end].mean(axis=0)
-
-        # Skip over unused frames
-        start = end + groupgap
+    # Copy or average the dark frames to match the group structure
+    # of the input science data
+    _average_groups(dark_data.data, avg_dark.data, nframes, groupgap)
 
     # Reset some metadata values for the averaged dark
     avg_dark.exp_nframes = nframes
@@ -290,28 +286,9 @@ def average_dark_frames_4d(dark_data, nints, ngroups, nframes, groupgap):
     if dint > nints:
         num_ints = nints
 
-    # Loop over valid integrations in dark reference file
-    # Loop over the groups of the input science data, copying or
-    # averaging the dark frames to match the group structure
-
-    for it in range(num_ints):
-        start = 0
-        for group in range(ngroups):
-            end = start + nframes
-
-            # If there's only 1 frame per group, just copy the dark frames
-            if nframes == 1:
-                log.debug("copy dark frame %d", start)
-                avg_dark.data[it, group] = dark_data.data[it, start]
-
-            # Otherwise average nframes into a new group: take the mean of
-            # the SCI arrays and the quadratic sum of the ERR arrays.
-            else:
-                log.debug("average dark frames %d to %d", start + 1, end)
-                avg_dark.data[it, group] = dark_data.data[it, start:end].mean(axis=0)
-
-            # Skip over unused frames
-            start = end + groupgap
+    # Copy or average the dark frames of the valid integrations to match
+    # the group structure of the input science data
+    _average_groups(dark_data.data[:num_ints], avg_dark.data[:num_ints], nframes, groupgap)
 
     # Reset some metadata values for the averaged dark
     avg_dark.exp_nframes = nframes
@@ -321,7 +298,64 @@ def average_dark_frames_4d(dark_data, nints, ngroups, nframes, groupgap):
     return avg_dark
 
 
-def subtract_dark(science_data, dark_data):
+def _average_groups(frames, avg_frames, nframes, groupgap):
+    """
+    Average dark frames into groups.
+
+    Each group is the mean of nframes consecutive frames, and groupgap
+    frames are skipped between groups.  Frames and groups are indexed by
+    the third from last axis, so any leading (integration) axes are
+    averaged at once.
+
+    Parameters
+    ----------
+    frames : ndarray
+        dark frames, shape (..., nframes_total, ny, nx)
+
+    avg_frames : ndarray
+        output array for the averaged groups, shape (..., ngroups, ny, nx)
+
+    nframes : int
+        number of frames per group in the science data set
+
+    groupgap : int
+        number of frames skipped between groups in the science data set
+    """
+    ngroups = avg_frames.shape[-3]
+    stride = nframes + groupgap
+    last = (ngroups - 1) * stride
+
+    # If there's only 1 frame per group, just copy the dark frames
+    if nframes == 1:
+        log.debug("copy every %d dark frames", stride)
+        avg_frames[...] = frames[..., : last + 1 : stride, :, :]
+        return
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", "Mean of empty slice", RuntimeWarning)
+        warnings.filterwarnings("ignore", "invalid value", RuntimeWarning)
+
+        # If the dark does not cover all of the science groups, average
+        # whatever frames are available for each group.
+        if frames.shape[-3] < last + nframes:
+            for group in range(ngroups):
+                start = group * stride
+                end = start + nframes
+                log.debug("average dark frames %d to %d", start + 1, end)
+                avg_frames[..., group, :, :] = frames[..., start:end, :, :].mean(axis=-3)
+            return
+
+        # Otherwise split the frames before the last group into blocks of
+        # nframes + groupgap and average the leading nframes of each block.
+        # The last group is averaged separately, since the frames skipped
+        # after it need not be present in the dark.
+        log.debug("average dark frames in blocks of %d, skipping %d", nframes, groupgap)
+        blocks = frames[..., :last, :, :].reshape(*frames.shape[:-3], ngroups - 1, stride, *frames.shape[-2:])
+        avg_frames[..., :-1, :, :] = blocks[..., :nframes, :, :].mean(axis=-3)
+        avg_frames[..., -1, :, :] = frames[..., last : last + nframes, :, :].mean(axis=-3)
+
+
+def subtract_dark(science_data, dark_data, in_place=False):
     """
     Subtracts dark current data from science arrays.
 
@@ -335,6 +369,12 @@ def subtract_dark(science_data, dark_data):
     dark_data : DarkData
         the dark current data
 
+    in_place : bool, optional
+        If True, the dark is subtracted directly from the science data
+        array and the input science data is returned, avoiding the
+        allocation of a new data array.  The input data are then no
+        longer available.
+
     Returns
     -------
     output : data model object
@@ -344,26 +384,73 @@ def subtract_dark(science_data, dark_data):
     # It defaults to 1 if the keyword is not in the science data.
     int_start = 1 if science_data.exp_intstart is None else science_data.exp_intstart
 
-    # Determine the number of integrations contained in the dark reference file
-    dark_nints = dark_data.data.shape[0] if len(dark_data.data.shape) == 4 else 1
+    sci_arr = science_data.data
+    dark_arr = dark_data.data
+    nints, ngroups = sci_arr.shape[:2]
+
+    # Only MIRI uses 4-D (integration-dependent) darks.  Determine the
+    # number of integrations contained in the dark reference file.
+    is_miri = dark_arr.ndim == 4
+    dark_nints = dark_arr.shape[0] if is_miri else 1
+
+    log.debug("subtract_dark: nints=%d, ngroups=%d, size=%d,%d", nints, ngroups, *sci_arr.shape[2:])
+
+    output = _create_output(science_data, dark_data, in_place=in_place)
+
+    if is_miri:
+        # Apply the first dark_nints integrations from the dark ref file
+        # to the first few science integrations. There's an additional
+        # check of the starting integration number in case the science
+        # data are segmented.  For science integrations beyond the number
+        # of dark integrations, use the last dark integration.
+        # Both subtractions broadcast views of the dark, so no
+        # integration-expanded copy of the dark is ever made.
+        nmatch = min(nints, dark_nints) if int_start == 1 else 0
+        np.subtract(sci_arr[:nmatch], dark_arr[:nmatch, :ngroups], out=output.data[:nmatch])
+        np.subtract(sci_arr[nmatch:], dark_arr[-1, :ngroups], out=output.data[nmatch:])
+    else:
+        # Use single-integration dark data for all integrations
+        np.subtract(sci_arr, dark_arr[:ngroups], out=output.data)
 
-    log.debug(
-        "subtract_dark: nints=%d, ngroups=%d, size=%d,%d",
-        science_data.data.shape[0],
-        science_data.data.shape[1],
-        science_data.data.shape[2],
-        science_data.data.shape[3],
-    )
+    return output
 
-    # Create output as a copy of the input science data model
-    output = copy.deepcopy(science_data)
 
-    if len(dark_data.data.shape) == 4:
+def _create_output(science_data, dark_data, in_place=False):
+    """
+    Create the output for dark subtraction of the science data.
+
+    The output shares all attributes with the science data except for a
+    newly allocated (uninitialized) data array and the pixel DQ array,
+    which has the dark DQ flags propagated into it.
+
+    Parameters
+    ----------
+    science_data : ScienceData
+        the input science data
+
+    dark_data : DarkData
+        the dark current data
+
+    in_place : bool, optional
+        If True, the science data itself is used as the output, keeping
+        its data array.
+
+    Returns
+    -------
+    output : ScienceData
+        science data to hold the dark-subtracted result
+    """
+    if in_place:
+        output = science_data
+    else:
+        # Create output as a shallow copy of the input science data, so that
+        # only the data array is newly allocated for the dark-subtracted result
+        output = science_data.shallow_copy_with_data(np.empty_like(science_data.data))
+
+    if dark_data.data.ndim == 4:
         # MIRI dark reference file has a DQ plane for each integration,
         # so we collapse the dark DQ planes into a single 2-D array
-        darkdq = dark_data.groupdq[0, 0, :, :].copy()
-        for i in range(1, dark_nints):
-            darkdq = np.bitwise_or(darkdq, dark_data.groupdq[i, 0, :, :])
+        darkdq = np.bitwise_or.reduce(dark_data.groupdq[:, 0, :, :], axis=0)
     else:
         # All other instruments have a single 2D dark DQ array
         darkdq = dark_data.groupdq
@@ -371,27 +458,52 @@ def subtract_dark(science_data, dark_data):
     # Propagate the dark DQ data into the science DQ data
     output.pixeldq = np.bitwise_or(science_data.pixeldq, darkdq)
 
-    # Loop over all integrations in input science data
-    for i in range(science_data.data.shape[0]):
-        if len(dark_data.data.shape) == 4:  # MIRI data
-            # Apply the first dark_nints-1 integrations from the dark ref file
-            # to the first few science integrations. There's an additional
-            # check of the starting integration number in case the science
-            # data are segmented.
-            #
-            # else
-            #
-            # For science integrations beyond the number of
-            # dark integrations, use the last dark integration
-            dark_sci = dark_data.data[i] if i < dark_nints and int_start == 1 else dark_data.data[-1]
-        else:
-            # Use single-integration dark data
-            dark_sci = dark_data.data
+    return output
+
+
+def _avg_and_subtract_streaming(science_data, dark_data, nframes, groupgap):
+    """
+    Average 3D dark frames and subtract them from the science data.
+
+    This gives the same result as subtracting the output of
+    average_dark_frames_3d, but each averaged dark group is subtracted
+    as soon as it is computed, so the full averaged dark is never held
+    in memory.
+
+    Parameters
+    ----------
+    science_data : ScienceData
+        the input science data
+
+    dark_data : DarkData
+        the input dark data, with 3D data
+
+    nframes : int
+        number of frames per group in the science data set
 
-        # Loop over all groups in this integration
-        for j in range(science_data.data.shape[1]):
-            # subtract the dark from the science data
-            output.data[i, j] -= dark_sci[j]
+    groupgap : int
+        number of frames skipped between groups in the science data set
+
+    Returns
+    -------
+    output : ScienceData
+        dark-subtracted science data
+    """
+    sci_arr = science_data.data
+    dark_arr = dark_data.data
+    ngroups = sci_arr.shape[1]
+
+    output = _create_output(science_data, dark_data)
+
+    # Buffer for a single averaged dark group, with the same data type
+    # as the averaged dark that would otherwise be created
+    avg_group = np.empty((1, *dark_arr.shape[1:]), dtype=np.float32)
+
+    stride = nframes + groupgap
+    for group in range(ngroups):
+        start = group * stride
+        _average_groups(dark_arr[start : start + nframes], avg_group, nframes, groupgap)
+        np.subtract(sci_arr[:, group], avg_group[0], out=output.data[:, group])
 
     return output
 
@@ -410,24 +522,20 @@ def extrapolate_dark(dark_data, ngroups):
     ngroups : int
         The number of groups to add to the dark array's ngroups.
     """
-
-    def _extrapolate_int(arr, ngroups):
-        """Extrapolate using rate derived from difference of last two groups."""
-        rate_arr = arr[-1, :, :] - arr[-2, :, :]
-        new_groups = (
-            np.broadcast_to(np.arange(1, ngroups + 1).reshape(-1, 1, 1), (ngroups, *rate_arr.shape))
-            * rate_arr
-            + arr[-1]
-        )
-        return np.concatenate((arr, new_groups))
-
-    if len(dark_data.data.shape) == 4:
-        nints, init_groups, nx, ny = dark_data.data.shape
-        tmp_dark = dark_data.data
-        dark_data.data = np.full((nints, init_groups + ngroups, nx, ny), np.nan)
-        for i in range(nints):
-            dark_data.data[i] = _extrapolate_int(tmp_dark[i], ngroups)
-    else:
-        dark_data.data = _extrapolate_int(dark_data.data, ngroups)
-
+    # The group axis is third from last for both 3-D and 4-D darks, so all
+    # integrations are extrapolated at once.
+    arr = dark_data.data
+    init_groups = arr.shape[-3]
+    new_arr = np.empty((*arr.shape[:-3], init_groups + ngroups, *arr.shape[-2:]), dtype=arr.dtype)
+    new_arr[..., :init_groups, :, :] = arr
+
+    # Extrapolate using rate derived from difference of last two groups,
+    # writing the new groups directly into the output buffer
+    rate_arr = arr[..., -1:, :, :] - arr[..., -2:-1, :, :]
+    new_groups = new_arr[..., init_groups:, :, :]
+    steps = np.arange(1, ngroups + 1, dtype=arr.dtype).reshape(-1, 1, 1)
+    np.multiply(steps, rate_arr, out=new_groups)
+    new_groups += arr[..., -1:, :, :]
+
+    dark_data.data = new_arr
     dark_data.exp_ngroups += ngroups
@@ -8,6 +8,7 @@ from numpy.testing import assert_allclose
 
 from stcal.dark_current.dark_class import DarkData, ScienceData
 from stcal.dark_current.dark_sub import average_dark_frames_3d as average_dark_frames
+from stcal.dark_current.dark_sub import average_dark_frames_4d, extrapolate_dark, subtract_dark
 from stcal.dark_current.dark_sub import do_correction_data as darkcorr
 
 dqflags = {
@@ -173,6 +174,41 @@ def test_frame_averaging(setup_nrc_cube, readpatt, ngroups, nframes, groupgap, n
     assert avg_dark.exp_groupgap == groupgap
 
 
+@pytest.mark.parametrize(("readpatt", "ngroups", "nframes", "groupgap", "nrows", "ncols"), _params())
+def test_frame_averaging_full_dark(readpatt, ngroups, nframes, groupgap, nrows, ncols):
+    """Check the frame averaging when the dark covers every science group."""
+    total_frames = (nframes * ngroups) + (groupgap * (ngroups - 1))
+
+    rng = np.random.default_rng(42)
+    dark = DarkData((total_frames + 2, nrows, ncols))
+    dark.data[:] = rng.random(dark.data.shape)
+
+    avg_dark = average_dark_frames(dark, ngroups, nframes, groupgap)
+
+    gstrt_ind = np.arange(ngroups) * (nframes + groupgap)
+    manual_avg = np.array([dark.data[gstart : gstart + nframes].mean(axis=0) for gstart in gstrt_ind])
+
+    assert_allclose(avg_dark.data, manual_avg, rtol=1e-5)
+
+
+@pytest.mark.parametrize(("readpatt", "ngroups", "nframes", "groupgap", "nrows", "ncols"), _params())
+def test_frame_averaging_4d(readpatt, ngroups, nframes, groupgap, nrows, ncols):
+    """Check the frame averaging of integration-dependent (MIRI-like) darks."""
+    nints = 2
+    total_frames = (nframes * ngroups) + (groupgap * (ngroups - 1))
+
+    rng = np.random.default_rng(42)
+    dark = DarkData((nints, total_frames + 2, nrows, ncols))
+    dark.data[:] = rng.random(dark.data.shape)
+
+    avg_dark = average_dark_frames_4d(dark, nints, ngroups, nframes, groupgap)
+
+    gstrt_ind = np.arange(ngroups) * (nframes + groupgap)
+    for i in range(nints):
+        manual_avg = np.array([dark.data[i, gstart : gstart + nframes].mean(axis=0) for gstart in gstrt_ind])
+        assert_allclose(avg_dark.data[i], manual_avg, rtol=1e-5)
+
+
 def test_sub_by_frame(make_rampmodel, make_darkmodel):
     """
     Check that if NFRAMES=1 and GROUPGAP=0 for the science data,
@@ -218,6 +254,75 @@ def test_sub_by_frame(make_rampmodel, make_darkmodel):
     np.testing.assert_allclose(outdata, diff, tol)
 
 
+@pytest.mark.parametrize(("int_start", "expected"), [(None, [0.1, 0.2, 0.2]), (3, [0.2, 0.2, 0.2])])
+def test_dark_integration_selection(make_rampmodel, make_darkmodel, int_start, expected):
+    """
+    Check that each science integration uses the matching dark integration,
+    that integrations beyond those in the dark use the last dark integration,
+    and that segmented data always use the last dark integration.
+    """
+    nints, ngroups, nrows, ncols = 3, 5, 10, 10
+
+    dm_ramp = make_rampmodel(nints, ngroups, nrows, ncols)
+    dm_ramp.exp_nframes = 1
+    dm_ramp.exp_groupgap = 0
+    dm_ramp.exp_intstart = int_start
+
+    dark = make_darkmodel(ngroups, nrows, ncols)
+    dark.data[0] = 0.1
+    dark.data[1] = 0.2
+
+    outfile, avg_dark = darkcorr(dm_ramp, dark)
+
+    for i in range(nints):
+        assert_allclose(outfile.data[i], 1.0 - expected[i], rtol=1e-6)
+
+
+def test_skip_dark_nframes_too_large(make_rampmodel, make_darkmodel):
+    """
+    Check that the correction is skipped when the dark has more frames
+    per group than the science data.
+    """
+    nints, ngroups, nrows, ncols = 1, 5, 10, 10
+
+    dm_ramp = make_rampmodel(nints, ngroups, nrows, ncols)
+    dm_ramp.exp_nframes = 1
+    dm_ramp.exp_groupgap = 0
+
+    dark = make_darkmodel(ngroups, nrows, ncols)
+    dark.exp_nframes = 2
+
+    outfile, avg_dark = darkcorr(dm_ramp, dark)
+
+    assert outfile.cal_step == "SKIPPED"
+    assert avg_dark is None
+    assert_allclose(outfile.data, 1.0)
+
+
+@pytest.mark.parametrize("in_place", [False, True])
+def test_subtract_dark_in_place(make_rampmodel, make_darkmodel, in_place):
+    """
+    Check that the dark is subtracted from a copy of the science data by
+    default, and from the science data itself when requested.
+    """
+    nints, ngroups, nrows, ncols = 2, 5, 10, 10
+
+    dm_ramp = make_rampmodel(nints, ngroups, nrows, ncols)
+    input_data = dm_ramp.data
+
+    dark = make_darkmodel(ngroups, nrows, ncols)
+    dark.data[:] = 0.25
+    dark.groupdq[0, 0, 5, 5] = dqflags["DO_NOT_USE"]
+
+    output = subtract_dark(dm_ramp, dark, in_place=in_place)
+
+    assert_allclose(output.data, 0.75)
+    assert output.pixeldq[5, 5] == dqflags["DO_NOT_USE"]
+    assert (output is dm_ramp) == in_place
+    assert (output.data is input_data) == in_place
+    assert_allclose(input_data, 0.75 if in_place else 1.0)
+
+
 def test_nan(make_rampmodel, make_darkmodel):
     """
     Verify that when a dark has NaNs, these are correctly
@@ -283,6 +388,7 @@ def test_dq_combine(make_rampmodel, make_darkmodel):
 
     dark.groupdq[0, 0, 50, 50] = dqflags["DO_NOT_USE"]
     dark.groupdq[0, 0, 50, 51] = dqflags["DO_NOT_USE"]
+    dark.groupdq[1, 0, 50, 52] = dqflags["DO_NOT_USE"]
 
     # run correction step
     outfile, avg_dark = darkcorr(dm_ramp, dark)
@@ -292,6 +398,9 @@ def test_dq_combine(make_rampmodel, make_darkmodel):
 
     assert outfile.pixeldq[50, 51] == np.bitwise_or(dqflags["SATURATED"], dqflags["DO_NOT_USE"])
 
+    # flags from every dark integration are combined
+    assert outfile.pixeldq[50, 52] == dqflags["DO_NOT_USE"]
+
 
 def test_frame_avg(make_rampmodel, make_darkmodel):
     """
@@ -334,6 +443,35 @@ def test_frame_avg(make_rampmodel, make_darkmodel):
     assert outfile.data[0, 3, 500, 500] == pytest.approx(2.65)
 
 
+@pytest.mark.parametrize(("readpatt", "ngroups", "nframes", "groupgap", "nrows", "ncols"), _params())
+def test_frame_avg_without_dark_output(setup_nrc_cube, readpatt, ngroups, nframes, groupgap, nrows, ncols):
+    """
+    Check that subtracting a frame-averaged dark gives the same result
+    whether or not the averaged dark is requested as output.
+    """
+    data, _ = setup_nrc_cube(readpatt, ngroups, nframes, groupgap, nrows, ncols)
+
+    total_frames = (nframes * ngroups) + (groupgap * (ngroups - 1))
+    dark = DarkData((total_frames, nrows, ncols))
+    dark.exp_nframes = 1
+    dark.exp_ngroups = total_frames
+    dark.exp_groupgap = 0
+
+    rng = np.random.default_rng(42)
+    data.data[:] = rng.random(data.data.shape)
+    dark.data[:] = rng.random(dark.data.shape)
+
+    outfile, avg_dark = darkcorr(data, dark)
+    assert avg_dark is None
+
+    expected, avg_dark = darkcorr(data, dark, dark_output="dark.fits")
+    assert avg_dark.save
+
+    assert outfile.cal_step == "COMPLETE"
+    assert_allclose(outfile.data, expected.data, rtol=1e-6)
+    np.testing.assert_array_equal(outfile.pixeldq, expected.pixeldq)
+
+
 def test_dark_extrapolation(make_rampmodel, make_darkmodel, setup_nrc_cube):
     """
     Check that the dark is extrapolated when it has insufficient frames to cover the science input.
@@ -384,3 +522,22 @@ def test_dark_extrapolation(make_rampmodel, make_darkmodel, setup_nrc_cube):
 
     assert_allclose(outfile.data[0, :, 10, 10], np.linspace(1, 32.2, nrc_ngroups), rtol=1.0e-5)
     assert_allclose(dark.data[:, 10, 10], np.linspace(0, 7.8, nrc_ngroups), rtol=1.0e-5)
+
+
+def test_extrapolate_dark_4d():
+    """
+    Check that each integration of a 4-D dark is extrapolated from its own
+    rate and that the dark keeps its data type.
+    """
+    dark = DarkData((2, 3, 4, 5))
+    dark.exp_ngroups = 3
+    dark.data[0] = np.arange(3, dtype=np.float32).reshape(-1, 1, 1)
+    dark.data[1] = 2 * np.arange(3, dtype=np.float32).reshape(-1, 1, 1) + 1
+
+    extrapolate_dark(dark, 4)
+
+    assert dark.data.shape == (2, 7, 4, 5)
+    assert dark.data.dtype == np.float32
+    assert dark.exp_ngroups == 7
+    assert_allclose(dark.data[0, :, 2, 2], np.arange(7))
+    assert_allclose(dark.data[1, :, 2, 2], 2 * np.arange(7) + 1)